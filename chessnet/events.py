@@ -1,37 +1,45 @@
 import asyncio
 from collections.abc import Iterable
-from enum import Enum
-from typing import Literal, Union
-import uuid
+from dataclasses import dataclass
+from enum import IntEnum
+import itertools
+import logging
+from typing import Awaitable, Callable, ClassVar, Dict, FrozenSet, Optional, Tuple, Union
 
-from pydantic.dataclasses import dataclass
+from chessnet.storage import Game, Move
 
-from chessnet.storage import Engine, Game, Move
 
+log = logging.getLogger(__name__)
 
-EventType = Enum("EventType", [
+
+EventType = IntEnum("EventType", [
     "START_GAME",
     "MAKE_MOVE",
     "END_GAME",
 ])
 
 
+# Events are published once per half-move, so they are slotted to keep them small.
+# The event type is a class-level discriminator rather than a per-instance field.
 @dataclass(frozen=True)
 class StartGameEvent:
-    typ: Literal[EventType.START_GAME]
+    __slots__ = ("game",)
+    typ: ClassVar[EventType] = EventType.START_GAME
     game: Game
 
 
 @dataclass(frozen=True)
 class EndGameEvent:
-    typ: Literal[EventType.END_GAME]
+    __slots__ = ("game_id", "outcome")
+    typ: ClassVar[EventType] = EventType.END_GAME
     game_id: str
     outcome: str
 
 
 @dataclass(frozen=True)
 class MakeMoveEvent:
-    typ: Literal[EventType.MAKE_MOVE]
+    __slots__ = ("game_id", "move", "fen_before", "engine_id")
+    typ: ClassVar[EventType] = EventType.MAKE_MOVE
     game_id: str
     move: Move
     fen_before: str
@@ -41,62 +49,134 @@ class MakeMoveEvent:
 Event = Union[
     StartGameEvent,
     EndGameEvent,
+    MakeMoveEvent,
 ]
 
+EventCallback = Callable[[Event], Awaitable[None]]
+
 
 class Events:
     @staticmethod
     def start_game(game: Game):
-        return StartGameEvent(EventType.START_GAME, game)
+        return StartGameEvent(game)
 
     @staticmethod
     def end_game(game_id: str, outcome: str):
-        return EndGameEvent(EventType.END_GAME, game_id, outcome)
+        return EndGameEvent(game_id, outcome)
 
     @staticmethod
     def make_move(game_id: str, move: Move, fen_before: str, engine_id: str):
-        return MakeMoveEvent(EventType.MAKE_MOVE, game_id, move, fen_before, engine_id)
-
-
-class Subscription:
-    def __init__(self, channel: str, typs: Iterable[EventType], callback):
-        self.channel = channel
-        self.typs = set(typs)
-        self.callback = callback
-
-    async def accept(self, event: Event):
-        if event.typ in self.typs:
-            await self.callback(event)
+        return MakeMoveEvent(game_id, move, fen_before, engine_id)
 
 
 class Broker:
     def __init__(self):
-        # Subscriptions per channel.
-        # Special key "*" for all.
-        self.subscriptions = {}
+        # Callbacks per (channel, event type), built at subscribe time.
+        # Buckets are tuples which are replaced rather than mutated, so a publish
+        # never observes a half-updated bucket.
+        self._index: Dict[Tuple[str, EventType], Tuple[EventCallback, ...]] = {}
+
+        # Callbacks subscribed to the special channel "*" (all channels), per event type.
+        self._wild: Dict[EventType, Tuple[EventCallback, ...]] = {}
+
+        # Channel, event types and callback per handle, so unsubscribe knows which
+        # buckets to clean up.
+        self.handles: Dict[int, Tuple[str, FrozenSet[EventType], EventCallback]] = {}
+        self._next_handle = itertools.count(1)
+
+        # Published events are queued and dispatched in batches by a single worker
+        # task, rather than spawning a task per subscriber per event.
+        # All created on first publish, since that's when we know we're in a loop.
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
 
     def publish(self, channel: str, event: Event):
-        for sub in self.subscriptions.get(channel, {}).values():
-            asyncio.create_task(sub.accept(event))
-
-        for sub in self.subscriptions.get("*", {}).values():
-            asyncio.create_task(sub.accept(event))
-
-    def subscribe(self, channel, typs: Iterable[EventType], callback) -> str:
-        handle = str(uuid.uuid4())
-        sub = Subscription(channel, typs, callback)
-        if channel not in self.subscriptions:
-            self.subscriptions[channel] = {}
-
-        self.subscriptions[channel][handle] = sub
+        if self._queue is None:
+            self._loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue()
+            self._worker = self._loop.create_task(self._drain(self._queue))
+
+        self._queue.put_nowait((channel, event))
+
+    async def close(self):
+        if self._worker is not None:
+            # Deliver anything already published before stopping.
+            await self._queue.join()
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+
+        self._loop = None
+        self._queue = None
+        self._worker = None
+
+    async def _drain(self, queue: asyncio.Queue):
+        while True:
+            batch = [await queue.get()]
+            while True:
+                try:
+                    batch.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            # Events are handled one at a time, in the order they were published,
+            # so e.g. a game's end is never stored before its start.
+            try:
+                for channel, event in batch:
+                    await self._dispatch(channel, event)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _dispatch(self, channel: str, event: Event):
+        typ = event.typ
+        callbacks = self._index.get((channel, typ), ()) + self._wild.get(typ, ())
+        if len(callbacks) == 1:
+            # The usual case, which needs no task for gather to wrap.
+            try:
+                await callbacks[0](event)
+            except Exception:
+                log.exception("Event callback failed")
+            return
+
+        results = await asyncio.gather(*(cb(event) for cb in callbacks), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                log.error("Event callback failed", exc_info=result)
+
+    def subscribe(self, channel, typs: Iterable[EventType], callback: EventCallback) -> int:
+        handle = next(self._next_handle)
+        typs = frozenset(typs)
+        for typ in typs:
+            if channel == "*":
+                self._wild[typ] = self._wild.get(typ, ()) + (callback,)
+            else:
+                key = (channel, typ)
+                self._index[key] = self._index.get(key, ()) + (callback,)
+
+        self.handles[handle] = (channel, typs, callback)
         return handle
 
-    def unsubscribe(self, handle: str):
-        channels = list(self.subscriptions.keys())
-        for channel in channels:
-            if handle in self.subscriptions[channel]:
-                del self.subscriptions[channel][handle]
-
-            if len(self.subscriptions[channel]) == 0:
-                del self.subscriptions[channel]
-
+    def unsubscribe(self, handle: int):
+        if handle not in self.handles:
+            return
+
+        channel, typs, callback = self.handles.pop(handle)
+        for typ in typs:
+            if channel == "*":
+                _remove_callback(self._wild, typ, callback)
+            else:
+                _remove_callback(self._index, (channel, typ), callback)
+
+
+def _remove_callback(buckets, key, callback: EventCallback):
+    callbacks = buckets[key]
+    i = callbacks.index(callback)
+    remaining = callbacks[:i] + callbacks[i + 1:]
+    if len(remaining) == 0:
+        del buckets[key]
+    else:
+        buckets[key] = remaining
@@ -1,15 +1,17 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import functools
 import logging
 import os
-import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import boto3
-import chess
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 from chessnet.storage import Engine
-from chessnet.runner import EngineRunner, ProtocolAdapter, TransportAdapter
+from chessnet.runner import ManagedEngineRunner
 
 
 AWS_REGION = os.getenv("AWS_REGION")
@@ -19,15 +21,51 @@ AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 CHESS_ENGINE_SUBNET = "subnet-014608c03e73462f2"
 CHESS_ENGINE_SECURITY_GROUP = "sg-09312f6d53bcafa4f"
 
+# Maximum number of AWS API calls in flight at once.
+AWS_MAX_CONCURRENCY = int(os.getenv("AWS_MAX_CONCURRENCY", "32"))
+
+# One HTTP connection per executor thread, so calls never queue for a connection.
+# Adaptive retries back off client-side when ECS starts throttling us.
+AWS_CLIENT_CONFIG = Config(
+    max_pool_connections=AWS_MAX_CONCURRENCY,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+)
+
+# How often to poll starting tasks, and how long to wait for them to come up.
+TASK_POLL_INTERVAL = 5
+TASK_START_TIMEOUT = 210
+
+# Maximum number of tasks ECS will describe in one call.
+DESCRIBE_TASKS_BATCH_SIZE = 100
 
 log = logging.getLogger(__name__)
 
+_aws_session: Optional[boto3.Session] = None
+_aws_clients: Dict[str, Any] = {}
+
+
+def get_aws_client(service: str):
+    # Building a client resolves endpoints and opens its own connection pool, so
+    # every manager shares one client per service. Clients are thread safe once
+    # created, but the session they come from is not, so create them up front.
+    global _aws_session
+    if _aws_session is None:
+        _aws_session = boto3.Session(
+            region_name=AWS_REGION,
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        )
+    if service not in _aws_clients:
+        _aws_clients[service] = _aws_session.client(service, config=AWS_CLIENT_CONFIG)
+    return _aws_clients[service]
+
 
 def run_in_executor(f):
+    # Runs the wrapped method on its instance's executor.
     @functools.wraps(f)
-    async def _async_f(*args, **kwargs):
+    async def _async_f(self, *args, **kwargs):
         loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, lambda: f(*args, **kwargs))
+        return await loop.run_in_executor(self.executor, lambda: f(self, *args, **kwargs))
     return _async_f
 
 
@@ -38,65 +76,58 @@ class RunningEngine:
     port: int
 
 
-class FargateRunner(EngineRunner):
-    def __init__(self, manager, engine):
-        self.manager = manager
-        self._engine = engine
-        self.protocol = None
-        self.running_engine = None
+class FargateRunner(ManagedEngineRunner):
+    def address(self, running_engine: RunningEngine) -> Tuple[str, int]:
+        return running_engine.ip_addr, running_engine.port
 
-    async def run(self):
-        log.info("Starting container...")
-        self.running_engine = await self.manager.run_engine(self._engine)
-        try:
-            log.info("Establishing connection...")
-            _, adapter = await asyncio.get_running_loop().create_connection(
-                    lambda: ProtocolAdapter(chess.engine.UciProtocol()),
-                    host=self.running_engine.ip_addr,
-                    port=self.running_engine.port)
-            self.protocol = adapter.protocol
 
-            log.info("Initializing engine...")
-            await self.protocol.initialize()
-        except:
-            await self.shutdown()
-            raise
+class FargateEngineManager():
+    TASK_DEF_VERSION = 2
 
-    async def play(self, board, limit):
-        return await self.protocol.play(board, limit)
+    def __init__(self, cluster):
+        self.client = get_aws_client('ecs')
+        self.ec2_client = get_aws_client('ec2')
+        self.cluster = cluster
 
-    async def shutdown(self, reason):
-        await self.manager.stop_engine(self.running_engine, reason)
+        # Everything but the task definition is the same for every task we run.
+        self.run_task_configuration = self._run_task_configuration()
 
-    def engine(self) -> Engine:
-        return self._engine
+        # boto3 is blocking, so AWS calls run on threads. Give them a dedicated pool
+        # so that many engines starting at once can't starve the loop's default
+        # executor, and vice versa.
+        self.executor = ThreadPoolExecutor(max_workers=AWS_MAX_CONCURRENCY, thread_name_prefix="aws")
 
+        # Task definition family per task name, once known to be up to date.
+        # Saves a describe_task_definition round trip on every engine start.
+        self.task_definitions: Dict[str, str] = {}
+        # Lookups in progress, by task name.
+        self.task_definition_lookups: Dict[str, asyncio.Future] = {}
 
-class FargateEngineManager():
-    TASK_DEF_VERSION = 2
+        # Task name per engine, which is used as both family and container name.
+        self.task_names: Dict[Engine, str] = {}
 
-    def __init__(self, cluster):
-        self.client = boto3.client(
-            'ecs',
-            region_name=AWS_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        )
-        self.ec2_client = boto3.client(
-            'ec2',
-            region_name=AWS_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        )
-        self.cluster = cluster
+        # Tasks waiting to start, keyed by task ARN. A single poller describes them
+        # all together rather than each engine polling on its own.
+        self.pending_tasks: Dict[str, asyncio.Future] = {}
+        self.poller: Optional[asyncio.Task] = None
 
-    @run_in_executor
-    def run_engine(self, engine):
-        task_def = self._get_or_create_task_definition(engine)
-        task = self.client.run_task(**self._run_task_configuration(task_def))["tasks"][0]
-        running_engine = self._wait_for_ready(task["taskArn"])
+    async def run_engine(self, engine):
+        task_def = await self._get_or_create_task_definition(engine)
+        task = await self._run_task(task_def)
+        running_engine = await self._wait_for_ready(task["taskArn"])
         return running_engine
 
+    async def prepare_task_definitions(self, engines: List[Engine]):
+        # Describes (and if needed registers) every engine's task definition at
+        # once, so games don't each wait on their own round trip when they start.
+        results = await asyncio.gather(
+            *(self._get_or_create_task_definition(engine) for engine in engines),
+            return_exceptions=True,
+        )
+        for engine, result in zip(engines, results):
+            if isinstance(result, Exception):
+                log.warning("Failed to prepare task definition for %s", engine, exc_info=result)
+
     @run_in_executor
     def stop_engine(self, running_engine: RunningEngine, reason: str):
         self.client.stop_task(
@@ -105,19 +136,46 @@ class FargateEngineManager():
             reason=reason,
         )
 
-    def _wait_for_ready(self, task_arn):
-        sleeps = [0, 5, 5, 10, 10, 30, 30, 60, 60]
-        for sleep in sleeps:
-            time.sleep(sleep)
+    async def _wait_for_ready(self, task_arn):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        self.pending_tasks[task_arn] = ready
+        if self.poller is None or self.poller.done():
+            self.poller = loop.create_task(self._poll_pending_tasks())
 
-            response = self.client.describe_tasks(cluster=self.cluster, tasks=[task_arn])
-            task = response["tasks"][0]
+        try:
+            return await asyncio.wait_for(ready, timeout=TASK_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise Exception("Task took too long to start")
+        finally:
+            del self.pending_tasks[task_arn]
+
+    async def _poll_pending_tasks(self):
+        while len(self.pending_tasks) > 0:
+            task_arns = list(self.pending_tasks.keys())
+            for i in range(0, len(task_arns), DESCRIBE_TASKS_BATCH_SIZE):
+                try:
+                    await self._poll_tasks(task_arns[i:i + DESCRIBE_TASKS_BATCH_SIZE])
+                except Exception:
+                    # Try again next time round, the waiters will time out if this persists.
+                    log.exception("Failed to poll starting tasks")
+
+            await asyncio.sleep(TASK_POLL_INTERVAL)
+
+    async def _poll_tasks(self, task_arns: List[str]):
+        # Task ARN for each network interface belonging to a running task.
+        running = {}
+
+        for task in await self._describe_tasks(task_arns):
+            task_arn = task["taskArn"]
 
             status = task["lastStatus"]
-            if status != "RUNNING":
+            if status == "STOPPED":
+                self._resolve_task(task_arn, exception=Exception(
+                    "Task stopped while waiting for it to start: " + task.get("stoppedReason", "unknown reason")))
+                continue
+            elif status != "RUNNING":
                 continue
-            elif status == "STOPPED":
-                raise Exception("Task stopped while waiting for it to start: " + task["stoppedReason"])
 
             eni = task["attachments"][0]
             if eni["status"] != "ATTACHED":
@@ -125,36 +183,93 @@ class FargateEngineManager():
 
             eni_id = self._eni_detail(eni, "networkInterfaceId")
             if eni_id is None:
-                raise Exception("Network interface ID is missing")
+                self._resolve_task(task_arn, exception=Exception("Network interface ID is missing"))
                 continue
 
-            eni_description = self.ec2_client.describe_network_interfaces(
-                NetworkInterfaceIds=[eni_id],
-            )["NetworkInterfaces"][0]
+            running[eni_id] = task_arn
 
-            ip_addr = eni_description["Association"]["PublicIp"]
+        if len(running) == 0:
+            return
 
-            return RunningEngine(task_arn=task_arn, ip_addr=ip_addr, port=3333)
+        for eni_description in await self._describe_network_interfaces(list(running.keys())):
+            task_arn = running[eni_description["NetworkInterfaceId"]]
+            ip_addr = eni_description.get("Association", {}).get("PublicIp")
+            if ip_addr is None:
+                # Not assigned yet. Check again next poll; the task times out if it never is.
+                continue
+            self._resolve_task(task_arn, result=RunningEngine(task_arn=task_arn, ip_addr=ip_addr, port=3333))
+
+    def _resolve_task(self, task_arn, result=None, exception=None):
+        ready = self.pending_tasks.get(task_arn)
+        if ready is None or ready.done():
+            return
+
+        if exception is not None:
+            ready.set_exception(exception)
+        else:
+            ready.set_result(result)
 
-        raise Exception("Task took too long to start")
+    @run_in_executor
+    def _run_task(self, task_def):
+        return self.client.run_task(taskDefinition=task_def, **self.run_task_configuration)["tasks"][0]
+
+    @run_in_executor
+    def _describe_tasks(self, task_arns):
+        return self.client.describe_tasks(cluster=self.cluster, tasks=task_arns)["tasks"]
 
-    def _get_or_create_task_definition(self, engine):
-        task_name = self._safe_name(engine.id())
+    @run_in_executor
+    def _describe_network_interfaces(self, eni_ids):
+        return self.ec2_client.describe_network_interfaces(
+            NetworkInterfaceIds=eni_ids,
+        )["NetworkInterfaces"]
+
+    async def _get_or_create_task_definition(self, engine):
+        task_name = self._task_name(engine)
+        if task_name in self.task_definitions:
+            return self.task_definitions[task_name]
+
+        # Engines starting together share one lookup, rather than each describing
+        # and maybe registering their own new revision.
+        lookup = self.task_definition_lookups.get(task_name)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._describe_or_register_task_definition(engine))
+            self.task_definition_lookups[task_name] = lookup
+            lookup.add_done_callback(lambda _: self.task_definition_lookups.pop(task_name, None))
+        # Shielded, so one waiter giving up doesn't cancel the lookup for the rest.
+        return await asyncio.shield(lookup)
+
+    @run_in_executor
+    def _describe_or_register_task_definition(self, engine):
+        task_name = self._task_name(engine)
         try:
             description = self.client.describe_task_definition(taskDefinition=task_name, include=["TAGS"])
+        except ClientError as e:
+            # Only a missing task definition means we should register one. Anything
+            # else (throttling, permissions, ...) would fail the register too.
+            if e.response["Error"]["Code"] not in ("ClientException", "ResourceNotFoundException"):
+                raise
+            task_def = self._register_task_definition(engine)
+        else:
             tags = description["tags"]
             if self._version_tag() not in tags:
                 # Old version of task definition, reregister.
-                task_def =  self.client.register_task_definition(**self._task_definition(engine))["taskDefinition"]
+                task_def = self._register_task_definition(engine)
             else:
                 # Up to date.
                 task_def = description["taskDefinition"]
-        except Exception as e:
-            task_def =  self.client.register_task_definition(**self._task_definition(engine))["taskDefinition"]
 
         log.info(task_def)
+        self.task_definitions[task_name] = task_def["family"]
         return task_def["family"]
 
+    def _register_task_definition(self, engine):
+        return self.client.register_task_definition(**self._task_definition(engine))["taskDefinition"]
+
+    def _task_name(self, engine):
+        if engine not in self.task_names:
+            self.task_names[engine] = self._safe_name(engine.id())
+        return self.task_names[engine]
+
     def _safe_name(self, name):
         return name.replace("#", "_")
 
@@ -165,12 +280,13 @@ class FargateEngineManager():
         return values[0]
 
     def _task_definition(self, engine):
+        task_name = self._task_name(engine)
         return {
-            "family": self._safe_name(engine.id()),
+            "family": task_name,
             "networkMode": "awsvpc",
             "containerDefinitions": [
                 {
-                    "name": self._safe_name(engine.id()),
+                    "name": task_name,
                     "image": engine.image,
                     "cpu": 2048,
                     "memory": 4096,
@@ -186,10 +302,9 @@ class FargateEngineManager():
             "tags": [self._version_tag()],
         }
 
-    def _run_task_configuration(self, task_def):
+    def _run_task_configuration(self):
         return {
             "cluster": self.cluster,
-            "taskDefinition": task_def,
             "capacityProviderStrategy": [
                 {
                     "capacityProvider": "FARGATE_SPOT",
@@ -1,9 +1,10 @@
 import asyncio
+import itertools
 import logging
+import os
 from typing import Optional
 
 import chess
-import docker
 
 from chessnet.events import Broker, Events
 from chessnet.runner import EngineRunner
@@ -12,6 +13,33 @@ from chessnet.storage import Move
 
 log = logging.getLogger(__name__)
 
+# Engines search a fixed number of nodes per move, so games run as fast as the
+# hardware allows. The time limit is the same cap moves always had, for engines
+# that ignore the node count.
+MOVE_NODES = int(os.getenv("MOVE_NODES", "100000"))
+MOVE_MAX_TIME = float(os.getenv("MOVE_MAX_TIME", "0.1"))
+MOVE_LIMIT = chess.engine.Limit(nodes=MOVE_NODES, time=MOVE_MAX_TIME)
+
+
+# A position needs at least this many reversible plies to have occurred five times.
+FIVEFOLD_MIN_PLIES = 16
+
+
+def game_outcome(board: chess.Board) -> Optional[chess.Outcome]:
+    # board.outcome() looks back through the whole game for a fivefold repetition
+    # on every call. Skip that until enough reversible moves have been played for
+    # one to be possible.
+    if board.halfmove_clock >= FIVEFOLD_MIN_PLIES:
+        return board.outcome()
+
+    if board.is_checkmate():
+        return chess.Outcome(chess.Termination.CHECKMATE, not board.turn)
+    if board.is_insufficient_material():
+        return chess.Outcome(chess.Termination.INSUFFICIENT_MATERIAL, None)
+    if not any(board.generate_legal_moves()):
+        return chess.Outcome(chess.Termination.STALEMATE, None)
+    return None
+
 
 async def play_game(broker: Broker, game_id: str, white: EngineRunner, black: EngineRunner) -> Optional[chess.Outcome]:
     board = chess.Board()
@@ -19,51 +47,60 @@ async def play_game(broker: Broker, game_id: str, white: EngineRunner, black: En
 
     log.info("Starting engines...")
     await asyncio.gather(white.run(), black.run())
+    white_id = white.engine().id()
+    black_id = black.engine().id()
+
+    players = itertools.cycle([("white", white, white_id), ("black", black, black_id)])
+    pending = None
+
+    # Per-move logging is at debug level, and skipped entirely unless enabled, to
+    # keep it off the move loop.
+    debug = log.isEnabledFor(logging.DEBUG)
 
     try:
-        log.info(board)
+        name, player, player_id = next(players)
+        if debug:
+            log.debug("Requesting %s move...", name)
+        pending = asyncio.ensure_future(player.play(board, MOVE_LIMIT))
+
         while True:
-            log.info("Requesting white move...")
-            res = await white.play(board, chess.engine.Limit(time=0.1))
-            log.info(f"Got move: {res.move}")
+            res = await pending
+            if debug:
+                log.debug("Got move: %s", res.move)
 
-            broker.publish(game_id, Events.make_move(
+            move_event = Events.make_move(
                 game_id,
                 Move(res.move.uci(), 0),
                 board.fen(),
-                white.engine().id(),
-            ))
+                player_id,
+            )
 
             board.push(res.move)
-            log.info(board)
+            if debug:
+                log.debug("\n%s", board)
 
-            outcome = board.outcome()
-            if outcome is not None:
-                log.info("Game over:", outcome.result())
-                break
+            outcome = game_outcome(board)
+            if outcome is None:
+                # Ask the opponent for its move before publishing this one, so that
+                # the broker work overlaps with the engine thinking.
+                # The board must not be touched again until the move comes back.
+                name, player, player_id = next(players)
+                if debug:
+                    log.debug("Requesting %s move...", name)
+                pending = asyncio.ensure_future(player.play(board, MOVE_LIMIT))
 
-            log.info("Requesting black move...")
-            res = await black.play(board, chess.engine.Limit(time=0.1))
-            log.info(f"Got move: {res.move}")
-
-            broker.publish(game_id, Events.make_move(
-                game_id,
-                Move(res.move.uci(), 0),
-                board.fen(),
-                white.engine().id(),
-            ))
-            board.push(res.move)
-            log.info("\n" + str(board))
+            broker.publish(game_id, move_event)
 
-            outcome = board.outcome()
             if outcome is not None:
-                log.info(f"Game over: {outcome.result()}")
+                log.info("Game over: %s", outcome.result())
                 break
 
         reason = "Game finished successfully"
-        await asyncio.gather(white.shutdown(reason), black.shutdown(reason))
+        await asyncio.gather(white.shutdown(reason, reusable=True), black.shutdown(reason, reusable=True))
     except Exception as e:
+        if pending is not None:
+            pending.cancel()
         reason = f"Game aborted due to error: {type(e).__name__}: {e}"
         await asyncio.gather(white.shutdown(reason), black.shutdown(reason))
 
-    return board.outcome()
+    return game_outcome(board)
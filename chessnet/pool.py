@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+# Idle engines kept per engine ID between games, and for how long (seconds).
+WARM_POOL_MAX_IDLE = int(os.getenv("WARM_POOL_MAX_IDLE", "2"))
+WARM_POOL_IDLE_TIMEOUT = int(os.getenv("WARM_POOL_IDLE_TIMEOUT", "600"))
+
+# Engines to launch per engine ID when the server starts, ahead of any games.
+WARM_POOL_PREWARM = int(os.getenv("WARM_POOL_PREWARM", "0"))
+
+log = logging.getLogger(__name__)
+
+
+class WarmPool:
+    # Engines kept running between games, so that back to back games with the
+    # same engine don't each pay the container cold start. Works with any manager
+    # that can run_engine(engine) and stop_engine(running_engine, reason).
+    def __init__(self, manager, max_idle=WARM_POOL_MAX_IDLE, idle_timeout=WARM_POOL_IDLE_TIMEOUT):
+        self.manager = manager
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+
+        # Idle engines per engine ID, along with the timer that will reap them.
+        self.idle: Dict[str, List[Tuple[Any, asyncio.TimerHandle]]] = {}
+
+        # Engines we're in the process of stopping.
+        self.stopping: Set[asyncio.Task] = set()
+
+    async def prewarm(self, engine, count):
+        # Keep whichever engines did start, even if others failed to.
+        results = await asyncio.gather(
+            *(self.manager.run_engine(engine) for _ in range(count)),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                log.warning("Failed to prewarm %s", engine, exc_info=result)
+            else:
+                self.release(engine, result)
+
+    def acquire(self, engine) -> Optional[Any]:
+        idle = self.idle.get(engine.id())
+        if not idle:
+            return None
+
+        running_engine, reaper = idle.pop()
+        reaper.cancel()
+        return running_engine
+
+    def release(self, engine, running_engine):
+        idle = self.idle.setdefault(engine.id(), [])
+        if len(idle) >= self.max_idle:
+            self._stop(running_engine, "Warm pool full")
+            return
+
+        reaper = asyncio.get_running_loop().call_later(self.idle_timeout, self._reap, engine.id(), running_engine)
+        idle.append((running_engine, reaper))
+
+    async def close(self):
+        for idle in self.idle.values():
+            for running_engine, reaper in idle:
+                reaper.cancel()
+                self._stop(running_engine, "Warm pool closed")
+        self.idle = {}
+
+        if len(self.stopping) > 0:
+            await asyncio.gather(*self.stopping, return_exceptions=True)
+
+    def _reap(self, engine_id, running_engine):
+        idle = self.idle[engine_id]
+        idle[:] = [(r, reaper) for r, reaper in idle if r is not running_engine]
+        self._stop(running_engine, "Idle in warm pool for too long")
+
+    def _stop(self, running_engine, reason):
+        task = asyncio.ensure_future(self.manager.stop_engine(running_engine, reason))
+        self.stopping.add(task)
+        task.add_done_callback(self.stopping.discard)
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 import asyncio
+import atexit
+from dataclasses import dataclass
 import logging
+from typing import Any, Optional, Tuple
 
 import chess
 from chess.engine import UciProtocol
@@ -11,6 +14,35 @@ from chessnet.storage import Engine
 
 log = logging.getLogger(__name__)
 
+# Engines may not be listening as soon as their container starts, so retry
+# refused connections with these delays (seconds), for up to CONNECT_TIMEOUT.
+CONNECT_RETRY_DELAYS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5]
+CONNECT_TIMEOUT = 5
+
+_docker_client: Optional[docker.DockerClient] = None
+
+
+def get_docker_client() -> docker.DockerClient:
+    # Connecting to the daemon probes its API version, so share one client
+    # between all local runners rather than connecting per game.
+    global _docker_client
+    if _docker_client is None:
+        _docker_client = docker.from_env()
+        atexit.register(_docker_client.close)
+    return _docker_client
+
+
+def set_event_loop_policy():
+    # Prefer uvloop where it's installed: engines are driven over many small TCP
+    # reads and writes, which is where its faster dispatch pays off. We only talk
+    # to engines over sockets, so chess.engine's child watcher isn't required.
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 
 class EngineRunner(ABC):
     @abstractmethod
@@ -22,7 +54,9 @@ class EngineRunner(ABC):
         pass
 
     @abstractmethod
-    def shutdown(self, reason):
+    def shutdown(self, reason, reusable=False):
+        # reusable is only set after a clean finish, when the engine may be kept
+        # for another game.
         pass
 
     @abstractmethod
@@ -30,27 +64,30 @@ class EngineRunner(ABC):
         pass
 
 
-class ProtocolAdapter(asyncio.Protocol):
+class ProtocolAdapter(asyncio.Protocol, asyncio.SubprocessTransport, asyncio.ReadTransport, asyncio.WriteTransport):
+    # Lets python-chess's engine protocols, which expect to drive a subprocess,
+    # run over a TCP connection. This is both the asyncio protocol for the socket
+    # and the subprocess transport handed to the engine protocol, so each chunk of
+    # engine output costs a single extra call.
+    __slots__ = ("protocol", "transport", "alive")
+
     def __init__(self, protocol):
+        super().__init__()
         self.protocol = protocol
+        self.transport = None
+        self.alive = True
 
     def connection_made(self, transport):
-        self.transport = TransportAdapter(transport)
-        self.protocol.connection_made(self.transport)
+        self.transport = transport
+        self.protocol.connection_made(self)
 
     def connection_lost(self, exc):
-        self.transport.alive = False
+        self.alive = False
         self.protocol.connection_lost(exc)
 
     def data_received(self, data):
         self.protocol.pipe_data_received(1, data)
 
-
-class TransportAdapter(asyncio.SubprocessTransport, asyncio.ReadTransport, asyncio.WriteTransport):
-    def __init__(self, transport):
-        self.alive = True
-        self.transport = transport
-
     def get_pipe_transport(self, fd):
         return self
 
@@ -69,37 +106,127 @@ class TransportAdapter(asyncio.SubprocessTransport, asyncio.ReadTransport, async
     # Unimplemented: kill(), send_signal(signal), terminate(), and various flow
     # control methods.
 
-class DockerFileRunner(EngineRunner):
-    def __init__(self, client, engine, local_port):
+
+async def connect_engine(host, port) -> ProtocolAdapter:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CONNECT_TIMEOUT
+    attempt = 0
+    while True:
+        try:
+            # Bound each attempt too, since a connection to an address that drops
+            # packets only fails after the OS connect timeout, minutes later.
+            _, adapter = await asyncio.wait_for(
+                    loop.create_connection(
+                        lambda: ProtocolAdapter(chess.engine.UciProtocol()),
+                        host=host,
+                        port=port),
+                    deadline - loop.time())
+            return adapter
+        except OSError:
+            delay = CONNECT_RETRY_DELAYS[min(attempt, len(CONNECT_RETRY_DELAYS) - 1)]
+            if loop.time() + delay > deadline:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+@dataclass
+class LocalEngine:
+    container: Any
+    port: int
+
+
+class DockerEngineManager:
+    # Runs engines as containers on the local docker daemon. Each container is
+    # published on a host port picked by docker, so any number can run at once.
+    def __init__(self, client):
         self.client = client
+
+    async def run_engine(self, engine) -> LocalEngine:
+        # The docker SDK is blocking, so keep its calls off the event loop. This
+        # also lets both engines' containers start at the same time.
+        return await asyncio.get_running_loop().run_in_executor(None, self._run_container, engine.image)
+
+    async def stop_engine(self, local_engine: LocalEngine, reason):
+        log.info("Stopping container %s: %s", local_engine.container.id, reason)
+        await asyncio.get_running_loop().run_in_executor(None, self._remove_container, local_engine.container)
+
+    def _run_container(self, image):
+        container = self.client.containers.run(image, detach=True, ports={"3333/tcp": None})
+        container.reload()
+        port = int(container.ports["3333/tcp"][0]["HostPort"])
+        return LocalEngine(container, port)
+
+    def _remove_container(self, container):
+        container.stop()
+        container.remove()
+
+
+class ManagedEngineRunner(EngineRunner):
+    # Plays an engine started by a manager, which can run_engine(engine) and
+    # stop_engine(running_engine, reason), over a TCP connection. With a warm pool,
+    # reuses an idle engine if there is one and hands it back afterwards.
+    def __init__(self, manager, engine, pool=None):
+        self.manager = manager
         self._engine = engine
-        self.image = engine.image
-        self.local_port = local_port
-        self.container = None
+        self.pool = pool
+        self.adapter = None
         self.protocol = None
+        self.running_engine = None
+
+    @abstractmethod
+    def address(self, running_engine) -> Tuple[str, int]:
+        # Host and port the running engine is listening on.
+        pass
 
     async def run(self):
-        self.container = self.client.containers.run(self.image, detach=True, ports={"3333/tcp": self.local_port})
+        if self.pool is not None:
+            self.running_engine = self.pool.acquire(self._engine)
+            if self.running_engine is not None:
+                try:
+                    await self._connect()
+                    return
+                except Exception:
+                    log.warning("Warm engine unusable, starting a new one", exc_info=True)
+                    await self.manager.stop_engine(self.running_engine, "Warm engine unusable")
+
+        log.info("Starting container...")
+        self.running_engine = await self.manager.run_engine(self._engine)
         try:
-            log.info("Establishing connection...")
-            _, adapter = await asyncio.get_running_loop().create_connection(lambda: ProtocolAdapter(chess.engine.UciProtocol()), host="localhost", port=self.local_port)
-            self.protocol = adapter.protocol
-
-            log.info("Initializing engine...")
-            await self.protocol.initialize()
+            await self._connect()
         except:
-            await self.shutdown()
+            await self.manager.stop_engine(self.running_engine, "Failed to connect to engine")
             raise
 
+    async def _connect(self):
+        log.info("Establishing connection...")
+        self.adapter = await connect_engine(*self.address(self.running_engine))
+        self.protocol = self.adapter.protocol
+
+        # A fresh protocol sends ucinewgame before its first move, so a reused
+        # engine doesn't carry state over from its previous game.
+        log.info("Initializing engine...")
+        await self.protocol.initialize()
+
     async def play(self, board, limit):
         return await self.protocol.play(board, limit)
 
-    async def shutdown(self, reason):
-        self.container.stop()
-        self.container.remove()
-        self.container = None
+    async def shutdown(self, reason, reusable=False):
+        alive = self.adapter is not None and self.adapter.alive
+        if self.adapter is not None:
+            self.adapter.close()
+
+        # An engine from an aborted game may have misbehaved or still be searching,
+        # so only a clean finish goes back to the pool.
+        if self.pool is not None and reusable and alive:
+            self.pool.release(self._engine, self.running_engine)
+        else:
+            await self.manager.stop_engine(self.running_engine, reason)
 
-    def engine(self):
+    def engine(self) -> Engine:
         return self._engine
 
 
+class DockerFileRunner(ManagedEngineRunner):
+    def address(self, local_engine: LocalEngine) -> Tuple[str, int]:
+        return "localhost", local_engine.port
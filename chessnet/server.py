@@ -1,34 +1,69 @@
 import asyncio
+import dataclasses
 import logging
-from typing import List, Optional
-import uuid
+from typing import Any, AsyncIterator, List, Optional
+import os
 import sys
 
+import orjson
 from pydantic.dataclasses import dataclass
-from quart import Quart
+from quart import Quart, Response, abort
 from quart_schema import QuartSchema, validate_response, validate_request
 from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 import chessnet.game
-from chessnet.events import Broker, Event, Events, EventType
+from chessnet.events import (
+    Broker, Event, Events, EventType,
+    EndGameEvent, MakeMoveEvent, StartGameEvent,
+)
 from chessnet.fargate import FargateEngineManager, FargateRunner
-from chessnet.storage import Engine, Game, Move
-from chessnet.sql import SqlStorage
+from chessnet.pool import WarmPool, WARM_POOL_PREWARM
+from chessnet.runner import set_event_loop_policy
+from chessnet.storage import Engine, Game, new_id
+from chessnet.sql import SqlStorage, configure_sqlite
+
+log = logging.getLogger(__name__)
+
+# Seconds between truncating checkpoints of the SQLite WAL.
+WAL_CHECKPOINT_INTERVAL = int(os.getenv("WAL_CHECKPOINT_INTERVAL", "300"))
+
+# Database connections kept open, and extra ones allowed under load. Without a
+# pool, SQLAlchemy opens a new SQLite connection (and aiosqlite thread) per query.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+# Maximum number of games to play at once. Further games wait for a free slot.
+MAX_CONCURRENT_GAMES = int(os.getenv("MAX_CONCURRENT_GAMES", "16"))
 
 app = Quart("ChessNET")
 
-engine = create_async_engine("sqlite+aiosqlite:///data.sqlite", echo=False, future=True)
+engine = create_async_engine(
+    "sqlite+aiosqlite:///data.sqlite",
+    echo=False,
+    future=True,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+)
+configure_sqlite(engine)
 fargate = FargateEngineManager("chess-net")
+warm_pool = WarmPool(fargate)
 storage = SqlStorage(engine)
 broker = Broker()
+wal_checkpointer: Optional[asyncio.Future] = None
+prewarmer: Optional[asyncio.Future] = None
+task_definition_preparer: Optional[asyncio.Future] = None
+# Created in before_serving, so that it binds to the serving loop.
+game_slots: asyncio.Semaphore
 
 
 async def store_event(event: Event):
-    if event.typ == EventType.START_GAME:
+    if isinstance(event, StartGameEvent):
         await storage.store_game(event.game)
-    elif event.typ == EventType.END_GAME:
+    elif isinstance(event, EndGameEvent):
         await storage.finish_game(event.game_id, event.outcome)
-    elif event.typ == EventType.MAKE_MOVE:
+    elif isinstance(event, MakeMoveEvent):
         await storage.store_move(event.game_id, event.move, event.fen_before, event.engine_id)
 
 
@@ -40,15 +75,95 @@ async def initialize_db():
     await storage.initialize()
 
 
-@dataclass
-class EnginesResponse:
-    engines: List[Engine]
+@app.before_serving
+async def create_game_slots():
+    global game_slots
+    game_slots = asyncio.Semaphore(MAX_CONCURRENT_GAMES)
+
+
+async def checkpoint_wal():
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_INTERVAL)
+        try:
+            await storage.checkpoint()
+        except Exception:
+            log.exception("WAL checkpoint failed")
+
+
+@app.before_serving
+async def start_wal_checkpoints():
+    global wal_checkpointer
+    wal_checkpointer = asyncio.ensure_future(checkpoint_wal())
+
+
+@app.before_serving
+async def prewarm_engines():
+    global prewarmer
+    if WARM_POOL_PREWARM > 0:
+        engines = await storage.list_engines()
+        # Don't hold up startup waiting for the containers.
+        prewarmer = asyncio.ensure_future(asyncio.gather(*(warm_pool.prewarm(e, WARM_POOL_PREWARM) for e in engines)))
+
+
+@app.before_serving
+async def prepare_task_definitions():
+    global task_definition_preparer
+    engines = await storage.list_engines()
+    # Runs in the background. Games and prewarming that start before it finishes
+    # wait on the same lookups.
+    task_definition_preparer = asyncio.ensure_future(fargate.prepare_task_definitions(engines))
+
+
+@app.after_serving
+async def close_broker():
+    await broker.close()
+
+
+@app.after_serving
+async def stop_wal_checkpoints():
+    if wal_checkpointer is not None:
+        wal_checkpointer.cancel()
+
+
+@app.after_serving
+async def close_storage():
+    await storage.close()
+
+
+@app.after_serving
+async def dispose_db():
+    # Each pooled connection holds an aiosqlite thread, which would otherwise keep
+    # the process alive after serving.
+    await engine.dispose()
+
+
+@app.after_serving
+async def stop_preparing_task_definitions():
+    # Safe to cancel: at worst a task definition is looked up again next time.
+    if task_definition_preparer is not None:
+        task_definition_preparer.cancel()
+        try:
+            await task_definition_preparer
+        except asyncio.CancelledError:
+            pass
+
+
+@app.after_serving
+async def close_warm_pool():
+    # Let prewarming finish rather than cancel it, since cancelling could leave
+    # tasks that have already been started running. The pool then stops them.
+    if prewarmer is not None:
+        try:
+            await prewarmer
+        except Exception:
+            log.exception("Prewarming engines failed")
+    await warm_pool.close()
 
 
 @app.route("/engines", methods=["GET"])
-@validate_response(EnginesResponse)  # type: ignore
 async def list_engines():
-    return EnginesResponse(await storage.list_engines())
+    # orjson encodes the dataclasses directly, skipping pydantic validation.
+    return Response(orjson.dumps({"engines": await storage.list_engines()}), content_type="application/json")
 
 
 @dataclass(frozen=True)
@@ -63,7 +178,6 @@ class RegisterEngineRequest:
 @validate_request(RegisterEngineRequest)  # type: ignore
 @validate_response(Engine)  # type: ignore
 async def register_engine(data: RegisterEngineRequest) -> Engine:
-    engine_id = str(uuid.uuid4())
     engine = Engine(
         family=data.family,
         variant=data.variant,
@@ -80,8 +194,10 @@ class PlayGameRequest:
     black: str
 
 
-@dataclass
+# Response-only, so a plain dataclass: there's nothing to validate on the way out.
+@dataclasses.dataclass(frozen=True)
 class PlayGameResponse:
+    __slots__ = ("game_id",)
     game_id: str
 
 
@@ -89,27 +205,24 @@ class PlayGameResponse:
 @validate_request(PlayGameRequest)  # type: ignore
 @validate_response(PlayGameResponse)  # type: ignore
 async def play_game(data: PlayGameRequest) -> PlayGameResponse:
-    game_id = str(uuid.uuid4())
-    white, black = await asyncio.gather(storage.get_engine(data.white), storage.get_engine(data.black))
+    game_id = new_id()
+    engines = await storage.get_engines([data.white, data.black])
+    white, black = engines[data.white], engines[data.black]
 
     async def _play():
-        #import docker
-        #from chessnet.runner import DockerFileRunner
-        #client = docker.from_env()
-        #white_runner = DockerFileRunner(client, white, 3333)
-        #black_runner = DockerFileRunner(client, black, 3334)
-        white_runner = FargateRunner(fargate, white)
-        black_runner = FargateRunner(fargate, black)
-        game = Game(
-            game_id=game_id,
-            timestamp=0,
-            white=data.white,
-            black=data.black,
-            outcome=None,
-        )
-        broker.publish(game_id, Events.start_game(game))
-        outcome = await chessnet.game.play_game(broker, game_id, white_runner, black_runner)
-        broker.publish(game_id, Events.end_game(game_id, outcome.result()))
+        async with game_slots:
+            white_runner = FargateRunner(fargate, white, warm_pool)
+            black_runner = FargateRunner(fargate, black, warm_pool)
+            game = Game(
+                game_id=game_id,
+                timestamp=0,
+                white=data.white,
+                black=data.black,
+                outcome=None,
+            )
+            broker.publish(game_id, Events.start_game(game))
+            outcome = await chessnet.game.play_game(broker, game_id, white_runner, black_runner)
+            broker.publish(game_id, Events.end_game(game_id, outcome.result()))
 
     # Explicitly kick this off asynchronously and just return the ID.
     asyncio.create_task(_play())
@@ -117,35 +230,39 @@ async def play_game(data: PlayGameRequest) -> PlayGameResponse:
     return PlayGameResponse(game_id)
 
 
-@dataclass
-class GamesResponse:
-    games: List[Game]
+async def stream_json(key: str, batches: AsyncIterator[List[Any]]) -> AsyncIterator[bytes]:
+    # Encodes {key: [...]} one batch of items at a time, so that large listings
+    # are never held in memory or encoded all at once.
+    yield f'{{"{key}": ['.encode()
+    sep = b""
+    async for batch in batches:
+        if len(batch) > 0:
+            # Strip the list brackets, as the batches are joined into one list.
+            yield sep + orjson.dumps(batch)[1:-1]
+            sep = b","
+    yield b"]}"
 
 
 @app.route("/games", methods=["GET"])
-@validate_response(GamesResponse)  # type: ignore
 async def list_games():
-    return GamesResponse(await storage.list_games())
+    return Response(stream_json("games", storage.iter_games()), content_type="application/json")
 
 
 @app.route("/games/<game_id>", methods=["GET"])
 @validate_response(Game)  # type: ignore
 async def get_game(game_id):
-    return await storage.get_game(game_id)
-
-
-@dataclass
-class MovesResponse:
-    moves: List[Move]
+    game = await storage.get_game(game_id)
+    if game is None:
+        abort(404)
+    return game
 
 
 @app.route("/games/<game_id>/moves", methods=["GET"])
-@validate_response(MovesResponse)  # type: ignore
 async def get_game_moves(game_id):
-    return MovesResponse(await storage.moves_in_game(game_id))
+    return Response(stream_json("moves", storage.iter_moves_in_game(game_id)), content_type="application/json")
 
 
 if __name__ == "__main__":
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
-    logging.getLogger("chess.engine").setLevel(logging.DEBUG)
+    set_event_loop_policy()
     app.run()
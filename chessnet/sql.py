@@ -1,8 +1,10 @@
 import asyncio
-from typing import List
+from collections import OrderedDict
+import logging
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 from sqlalchemy import (
-    delete, insert, select, update,
+    event, inspect, text, bindparam, delete, insert, or_, select, update,
     ForeignKey, Index, MetaData, Table, Column,
     String, Integer,
 )
@@ -10,16 +12,79 @@ from sqlalchemy.ext.asyncio import create_async_engine
 
 from chessnet.storage import Game, Engine, Move, Storage
 
+log = logging.getLogger(__name__)
+
+# Maximum number of engines to keep cached in memory.
+ENGINE_CACHE_SIZE = 4096
+
+# Maximum number of moves to insert in a single transaction.
+MOVE_BATCH_SIZE = 128
+
+# Delays (seconds) between retries of a batch of moves that failed to write,
+# e.g. because another connection held the database lock.
+MOVE_WRITE_RETRY_DELAYS = [0.1, 0.5, 1, 5]
+
+# Maximum number of moves waiting to be written. store_move waits for space
+# beyond this, so a slow database can't grow the queue without bound.
+MOVE_QUEUE_SIZE = 8192
+
+# Maximum number of position IDs to keep cached in memory, keyed by FEN.
+POSITION_CACHE_SIZE = 65536
+
+# Rows fetched from the database at a time when streaming results.
+STREAM_BATCH_SIZE = 500
+
+# Applied to every new SQLite connection. WAL with synchronous=NORMAL only
+# fsyncs at checkpoints, rather than on every commit.
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+]
+
+
+def configure_sqlite(db):
+    @event.listens_for(db.sync_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
 
 class SqlStorage(Storage):
     def __init__(self, db):
         self.db = db
         self.metadata = MetaData()
 
+        # Engines are immutable once registered, so cache lookups by ID (LRU).
+        self.engine_cache: OrderedDict[str, Engine] = OrderedDict()
+        # Whether the cache holds every engine, so listings can skip the database.
+        # Set when all engines are preloaded in initialize(), and cleared as soon
+        # as the cache evicts one.
+        self.all_engines_cached = False
+        # Locks for engines currently being fetched, so that concurrent misses for
+        # the same engine wait for the first fetch rather than all querying.
+        self.engine_fetch_locks: Dict[str, asyncio.Lock] = {}
+
+        # IDs of recently stored positions by FEN (LRU), so most moves don't need
+        # to look up their position.
+        self.position_cache: OrderedDict[str, int] = OrderedDict()
+
+        # Moves are queued and written in batches by a background task.
+        self.move_queue: asyncio.Queue[Tuple[str, str, str, str, int]]
+        self.move_writer: asyncio.Future
+        # Moves queued but not yet written, per game, and events set once a game
+        # has none left. Reads wait on their own game's moves only.
+        self.pending_moves: Dict[str, int] = {}
+        self.moves_written: Dict[str, asyncio.Event] = {}
+
         self.engines_table = Table(
             "engines",
             self.metadata,
-            Column("engine_id", String, primary_key=True),
+            Column("engine_id", String(64), primary_key=True),
             Column("family", String, nullable=False),
             Column("variant", String, nullable=False),
             Column("version", String, nullable=False),
@@ -29,109 +94,399 @@ class SqlStorage(Storage):
         self.games_table = Table(
             "games",
             self.metadata,
-            Column("game_id", String, primary_key=True),
-            Column("timestamp", Integer, nullable=False),
-            Column("white", ForeignKey("engines.engine_id"), nullable=False, index=True),
-            Column("black", ForeignKey("engines.engine_id"), nullable=False, index=True),
+            Column("game_id", String(64), primary_key=True),
+            Column("timestamp", Integer, nullable=False, index=True),
+            Column("white", ForeignKey("engines.engine_id"), nullable=False),
+            Column("black", ForeignKey("engines.engine_id"), nullable=False),
             Column("outcome", String),
+
+            # Each side of games_for_engine's OR is served by one of these.
+            Index("idx_games_white", "white", "timestamp"),
+            Index("idx_games_black", "black", "timestamp"),
+        )
+
+        # Positions recur across many games, so each FEN is stored once and moves
+        # refer to it by ID.
+        self.positions_table = Table(
+            "positions",
+            self.metadata,
+            Column("position_id", Integer, primary_key=True),
+            Column("fen", String(128), nullable=False, unique=True),
         )
 
         self.moves_table = Table(
             "moves",
             self.metadata,
-            Column("game_id", ForeignKey("games.game_id"), nullable=False, index=True),
+            Column("game_id", ForeignKey("games.game_id"), nullable=False),
             Column("engine_id", ForeignKey("engines.engine_id"), nullable=False),
-            Column("fen_before", String, nullable=False, index=True),
-            Column("uci", String, nullable=False),
+            Column("position_id", ForeignKey("positions.position_id"), nullable=False, index=True),
+            Column("uci", String(8), nullable=False),
             Column("timestamp", Integer, nullable=False),
 
-            Index("idx_engine_positions", "engine_id", "fen_before"),
+            Index("idx_engine_positions", "engine_id", "position_id"),
+            # Serves moves_in_game without a sort.
+            Index("idx_game_moves", "game_id", "timestamp"),
         )
 
+        # Statements are built once and reused for every call, with values passed
+        # as bind parameters. Queries select just the columns the _load_* methods
+        # unpack, in order.
+        engine_columns = [
+            self.engines_table.c.family,
+            self.engines_table.c.variant,
+            self.engines_table.c.version,
+            self.engines_table.c.image,
+        ]
+        self.list_engines_stmt = select(*engine_columns)
+        self.get_engine_stmt = (
+                select(*engine_columns)
+                .where(self.engines_table.c.engine_id == bindparam("engine_id")))
+        self.get_engines_stmt = (
+                select(*engine_columns)
+                .where(self.engines_table.c.engine_id.in_(bindparam("engine_ids", expanding=True))))
+        self.insert_engine_stmt = insert(self.engines_table)
+        self.delete_engine_stmt = (
+                delete(self.engines_table)
+                .where(self.engines_table.c.engine_id == bindparam("engine_id")))
+
+        game_columns = [
+            self.games_table.c.game_id,
+            self.games_table.c.timestamp,
+            self.games_table.c.white,
+            self.games_table.c.black,
+            self.games_table.c.outcome,
+        ]
+        self.list_games_stmt = (
+                select(*game_columns)
+                .order_by(self.games_table.c.timestamp.desc()))
+        self.get_game_stmt = (
+                select(*game_columns)
+                .where(self.games_table.c.game_id == bindparam("game_id")))
+        self.games_for_engine_stmt = (
+                select(*game_columns)
+                .where(or_(
+                    self.games_table.c.white == bindparam("engine_id"),
+                    self.games_table.c.black == bindparam("engine_id")))
+                .order_by(self.games_table.c.timestamp.desc()))
+        self.insert_game_stmt = insert(self.games_table)
+        self.finish_game_stmt = (
+                update(self.games_table)
+                .where(self.games_table.c.game_id == bindparam("finished_game_id")))
+
+        self.moves_in_game_stmt = (
+                select(self.moves_table.c.uci, self.moves_table.c.timestamp)
+                .where(self.moves_table.c.game_id == bindparam("game_id"))
+                .order_by(self.moves_table.c.timestamp))
+
+        self.get_positions_stmt = (
+                select(self.positions_table.c.position_id, self.positions_table.c.fen)
+                .where(self.positions_table.c.fen.in_(bindparam("fens", expanding=True))))
+        self.insert_positions_sql = "INSERT OR IGNORE INTO positions (fen) VALUES (?)"
+
+        # Move batches go straight to the driver's executemany, skipping
+        # SQLAlchemy's per-row parameter processing. Rows are tuples in column
+        # order, as built by _write_moves.
+        self.insert_moves_sql = "INSERT INTO moves ({}) VALUES ({})".format(
+                ", ".join(c.name for c in self.moves_table.c),
+                ", ".join("?" for _ in self.moves_table.c))
+
 
     async def initialize(self):
+        self.move_queue = asyncio.Queue(MOVE_QUEUE_SIZE)
+
         async with self.db.begin() as conn:
+            await conn.run_sync(self._migrate_moves)
             await conn.run_sync(self.metadata.create_all)
+            await conn.run_sync(self._create_indexes)
+
+            # There are few engines and they're read on every game, so keep them
+            # all in memory if they fit.
+            result = await conn.execute(self.list_engines_stmt)
+            engines = [self._load_engine(row) for row in result]
+        if len(engines) <= ENGINE_CACHE_SIZE:
+            for engine in engines:
+                self._cache_engine(engine)
+            self.all_engines_cached = True
+
+        self.move_writer = asyncio.ensure_future(self._write_moves())
+
+    async def flush(self):
+        await self.move_queue.join()
+
+    async def close(self):
+        await self.flush()
+        self.move_writer.cancel()
+        try:
+            await self.move_writer
+        except asyncio.CancelledError:
+            pass
 
 
+    async def checkpoint(self):
+        async with self.db.connect() as conn:
+            await conn.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+
     async def list_engines(self) -> List[Engine]:
-        async with self.db.begin() as conn:
-            result = await conn.stream(select(self.engines_table))
-            return [self._load_engine(row) async for row in result]
+        if self.all_engines_cached:
+            return list(self.engine_cache.values())
+
+        async with self.db.connect() as conn:
+            result = await conn.execute(self.list_engines_stmt)
+            return [self._load_engine(row) for row in result]
 
     async def store_engine(self, engine: Engine):
         async with self.db.begin() as conn:
-            await conn.execute(insert(self.engines_table).values(**self._store_engine(engine)))
+            await conn.execute(self.insert_engine_stmt, self._store_engine(engine))
+        self._cache_engine(engine)
 
     async def get_engine(self, engine_id: str) -> Engine:
-        async with self.db.begin() as conn:
-            result = await conn.execute(
-                    select(self.engines_table)
-                    .where(self.engines_table.c.engine_id == engine_id))
-            engines = [self._load_engine(row) for row in result]
+        engine = self._cached_engine(engine_id)
+        if engine is not None:
+            return engine
+
+        lock = self.engine_fetch_locks.setdefault(engine_id, asyncio.Lock())
+        try:
+            async with lock:
+                engine = self._cached_engine(engine_id)
+                if engine is not None:
+                    return engine
+
+                async with self.db.connect() as conn:
+                    result = await conn.execute(self.get_engine_stmt, {"engine_id": engine_id})
+                    engines = [self._load_engine(row) for row in result]
+
+                if len(engines) != 1:
+                    raise Exception(f"No engine with ID: {engine_id}")
+
+                self._cache_engine(engines[0])
+                return engines[0]
+        finally:
+            if self.engine_fetch_locks.get(engine_id) is lock:
+                del self.engine_fetch_locks[engine_id]
 
-        if len(engines) != 1:
-            raise Exception("No engine with ID: {}", engine_id)
-        return engines[0]
+    async def get_engines(self, engine_ids: List[str]) -> Dict[str, Engine]:
+        engines = {}
+        missing = []
+        for engine_id in engine_ids:
+            cached = self._cached_engine(engine_id)
+            if cached is not None:
+                engines[engine_id] = cached
+            else:
+                missing.append(engine_id)
+
+        if len(missing) > 0:
+            async with self.db.connect() as conn:
+                result = await conn.execute(self.get_engines_stmt, {"engine_ids": missing})
+                for row in result:
+                    engine = self._load_engine(row)
+                    self._cache_engine(engine)
+                    engines[engine.id()] = engine
+
+        for engine_id in engine_ids:
+            if engine_id not in engines:
+                raise Exception(f"No engine with ID: {engine_id}")
+        return engines
 
     async def delete_engine(self, engine_id: str):
         async with self.db.begin() as conn:
-            await conn.execute(
-                    delete(self.engines_table)
-                    .where(self.engines_table.c.engine_id == engine_id))
+            await conn.execute(self.delete_engine_stmt, {"engine_id": engine_id})
+        self.engine_cache.pop(engine_id, None)
 
     async def list_games(self) -> List[Game]:
-        async with self.db.begin() as conn:
-            result = await conn.stream(
-                    select(self.games_table)
-                    .order_by(self.games_table.c.timestamp.desc()))
-            return [self._load_game(row) async for row in result]
+        async with self.db.connect() as conn:
+            result = await conn.execute(self.list_games_stmt)
+            return [self._load_game(row) for row in result]
+
+    async def iter_games(self) -> AsyncIterator[List[Game]]:
+        async with self.db.connect() as conn:
+            result = await conn.stream(self.list_games_stmt)
+            async for rows in result.partitions(STREAM_BATCH_SIZE):
+                yield [self._load_game(row) for row in rows]
 
     async def store_game(self, game: Game):
         async with self.db.begin() as conn:
-            await conn.execute(insert(self.games_table).values(**self._store_game(game)))
+            await conn.execute(self.insert_game_stmt, self._store_game(game))
 
     async def finish_game(self, game_id: str, outcome: str):
         async with self.db.begin() as conn:
-            await conn.execute(
-                    update(self.games_table)
-                    .where(self.games_table.c.game_id == game_id)
-                    .values(outcome=outcome))
+            await conn.execute(self.finish_game_stmt, {"finished_game_id": game_id, "outcome": outcome})
 
-    async def get_game(self, game_id: str) -> Game:
-        async with self.db.begin() as conn:
-            result = await conn.stream(
-                    select(self.games_table)
-                    .where(self.games_table.c.game_id == game_id))
-            return self._load_game(await result.first())
+    async def get_game(self, game_id: str) -> Optional[Game]:
+        async with self.db.connect() as conn:
+            result = await conn.execute(self.get_game_stmt, {"game_id": game_id})
+            row = result.one_or_none()
+        return None if row is None else self._load_game(row)
 
     async def games_for_engine(self, engine_id: str) -> List[Game]:
-        async with self.db.begin() as conn:
-            result = await conn.stream(
-                    select(self.games_table)
-                    .where(self.games_table.c.white == engine_id or self.games_table.c.black == engine_id))
-            return [self._load_game(row) async for row in result]
+        async with self.db.connect() as conn:
+            result = await conn.execute(self.games_for_engine_stmt, {"engine_id": engine_id})
+            return [self._load_game(row) for row in result]
 
     async def store_move(self, game_id: str, move: Move, fen_before: str, engine_id: str):
-        async with self.db.begin() as conn:
-            await conn.execute(
-                    insert(self.moves_table)
-                    .values(**self._store_move(game_id, move, fen_before, engine_id)))
+        self._add_pending_moves(game_id, 1)
+        try:
+            await self.move_queue.put(self._store_move(game_id, move, fen_before, engine_id))
+        except BaseException:
+            self._remove_pending_moves(game_id, 1)
+            raise
+
+    async def store_moves(self, game_id: str, moves: List[Tuple[Move, str, str]]):
+        # Each entry is (move, fen_before, engine_id).
+        self._add_pending_moves(game_id, len(moves))
+        queued = 0
+        try:
+            for move, fen_before, engine_id in moves:
+                await self.move_queue.put(self._store_move(game_id, move, fen_before, engine_id))
+                queued += 1
+        except BaseException:
+            self._remove_pending_moves(game_id, len(moves) - queued)
+            raise
 
     async def moves_in_game(self, game_id: str) -> List[Move]:
+        await self._flush_game(game_id)
+        async with self.db.connect() as conn:
+            result = await conn.execute(self.moves_in_game_stmt, {"game_id": game_id})
+            return [self._load_move(row) for row in result]
+
+    def _migrate_moves(self, conn):
+        # Databases from before the positions table stored each move's FEN inline,
+        # in moves.fen_before. Move the FENs into positions and rebuild moves to
+        # refer to them, within initialize()'s transaction.
+        inspector = inspect(conn)
+        if not inspector.has_table("moves"):
+            return
+        if "fen_before" not in {c["name"] for c in inspector.get_columns("moves")}:
+            return
+
+        log.info("Migrating moves to the positions table...")
+        self.positions_table.create(conn, checkfirst=True)
+        conn.exec_driver_sql("INSERT OR IGNORE INTO positions (fen) SELECT DISTINCT fen_before FROM moves")
+
+        # The old table's indexes keep their names when it's renamed, and some
+        # clash with the new table's, so drop them first.
+        conn.exec_driver_sql("ALTER TABLE moves RENAME TO moves_old")
+        for index in inspector.get_indexes("moves_old"):
+            conn.exec_driver_sql('DROP INDEX "{}"'.format(index["name"]))
+        self.moves_table.create(conn)
+        conn.exec_driver_sql(
+                "INSERT INTO moves (game_id, engine_id, position_id, uci, timestamp) "
+                "SELECT m.game_id, m.engine_id, p.position_id, m.uci, m.timestamp "
+                "FROM moves_old m JOIN positions p ON p.fen = m.fen_before")
+        conn.exec_driver_sql("DROP TABLE moves_old")
+
+    def _create_indexes(self, conn):
+        # create_all skips tables that already exist, so add any indexes that are
+        # newer than the database.
+        for table in self.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+    async def _write_moves(self):
+        while True:
+            rows = [await self.move_queue.get()]
+            while len(rows) < MOVE_BATCH_SIZE and not self.move_queue.empty():
+                rows.append(self.move_queue.get_nowait())
+
+            try:
+                # store_move has already returned, so try hard before dropping moves.
+                for delay in MOVE_WRITE_RETRY_DELAYS + [None]:
+                    try:
+                        await self._insert_moves(rows)
+                        break
+                    except Exception:
+                        if delay is None:
+                            log.exception("Failed to store %d moves", len(rows))
+                        else:
+                            log.warning("Failed to store %d moves, retrying in %ss", len(rows), delay, exc_info=True)
+                            await asyncio.sleep(delay)
+            finally:
+                for game_id, _, _, _, _ in rows:
+                    self._remove_pending_moves(game_id, 1)
+                    self.move_queue.task_done()
+
+    def _add_pending_moves(self, game_id: str, count: int):
+        if count == 0:
+            return
+        self.pending_moves[game_id] = self.pending_moves.get(game_id, 0) + count
+        if game_id not in self.moves_written:
+            self.moves_written[game_id] = asyncio.Event()
+
+    def _remove_pending_moves(self, game_id: str, count: int):
+        if count == 0:
+            return
+        self.pending_moves[game_id] -= count
+        if self.pending_moves[game_id] == 0:
+            del self.pending_moves[game_id]
+            self.moves_written.pop(game_id).set()
+
+    async def _flush_game(self, game_id: str):
+        written = self.moves_written.get(game_id)
+        if written is not None:
+            await written.wait()
+
+    async def _insert_moves(self, rows):
         async with self.db.begin() as conn:
-            result = await conn.stream(
-                    select(self.moves_table.c.uci, self.moves_table.c.timestamp)
-                    .where(self.moves_table.c.game_id == game_id)
-                    .order_by(self.moves_table.c.timestamp))
-            return [self._load_move(row) async for row in result]
+            position_ids = await self._position_ids(conn, {fen for _, _, fen, _, _ in rows})
+            await conn.exec_driver_sql(self.insert_moves_sql, [
+                (game_id, engine_id, position_ids[fen], uci, timestamp)
+                for game_id, engine_id, fen, uci, timestamp in rows
+            ])
+
+        # Only cache IDs once they're committed.
+        for fen, position_id in position_ids.items():
+            self._cache_position(fen, position_id)
+
+    async def _position_ids(self, conn, fens) -> Dict[str, int]:
+        position_ids = {}
+        missing = []
+        for fen in fens:
+            cached = self.position_cache.get(fen)
+            if cached is not None:
+                self.position_cache.move_to_end(fen)
+                position_ids[fen] = cached
+            else:
+                missing.append(fen)
+
+        if len(missing) > 0:
+            await conn.exec_driver_sql(self.insert_positions_sql, [(fen,) for fen in missing])
+            result = await conn.execute(self.get_positions_stmt, {"fens": missing})
+            for position_id, fen in result:
+                position_ids[fen] = position_id
+        return position_ids
+
+    def _cache_position(self, fen: str, position_id: int):
+        self.position_cache[fen] = position_id
+        self.position_cache.move_to_end(fen)
+        if len(self.position_cache) > POSITION_CACHE_SIZE:
+            self.position_cache.popitem(last=False)
+
+    async def iter_moves_in_game(self, game_id: str) -> AsyncIterator[List[Move]]:
+        await self._flush_game(game_id)
+        async with self.db.connect() as conn:
+            result = await conn.stream(self.moves_in_game_stmt, {"game_id": game_id})
+            async for rows in result.partitions(STREAM_BATCH_SIZE):
+                yield [self._load_move(row) for row in rows]
+
+    def _cached_engine(self, engine_id: str) -> Optional[Engine]:
+        engine = self.engine_cache.get(engine_id)
+        if engine is not None:
+            self.engine_cache.move_to_end(engine_id)
+        return engine
+
+    def _cache_engine(self, engine: Engine):
+        self.engine_cache[engine.id()] = engine
+        self.engine_cache.move_to_end(engine.id())
+        if len(self.engine_cache) > ENGINE_CACHE_SIZE:
+            self.engine_cache.popitem(last=False)
+            self.all_engines_cached = False
 
     def _load_engine(self, row):
+        family, variant, version, image = row
         return Engine(
-            family=row.family,
-            variant=row.variant,
-            version=row.version,
-            image=row.image,
+            family=family,
+            variant=variant,
+            version=version,
+            image=image,
         )
 
     def _store_engine(self, engine):
@@ -144,12 +499,13 @@ class SqlStorage(Storage):
         }
 
     def _load_game(self, row):
+        game_id, timestamp, white, black, outcome = row
         return Game(
-            game_id=row.game_id,
-            timestamp=row.timestamp,
-            white=row.white,
-            black=row.black,
-            outcome=row.outcome,
+            game_id=game_id,
+            timestamp=timestamp,
+            white=white,
+            black=black,
+            outcome=outcome,
         )
 
     def _store_game(self, game):
@@ -162,17 +518,18 @@ class SqlStorage(Storage):
         }
 
     def _load_move(self, row):
+        uci, timestamp = row
         return Move(
-            uci=row.uci,
-            timestamp=row.timestamp,
+            uci=uci,
+            timestamp=timestamp,
         )
 
     def _store_move(self, game_id: str, move: Move, fen_before: str, engine_id: str):
-        return {
-            "game_id": game_id,
-            "uci": move.uci,
-            "timestamp": move.timestamp,
-            "fen_before": fen_before,
-            "engine_id": engine_id,
-        }
+        return (
+            game_id,
+            engine_id,
+            fen_before,
+            move.uci,
+            move.timestamp,
+        )
 
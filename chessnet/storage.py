@@ -1,21 +1,30 @@
 from abc import ABC, abstractmethod
-from pydantic.dataclasses import dataclass
-from typing import List, Optional
-
-import json
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 import os
-import pickle
+import time
+import uuid
 
 
+# Records are built for every row read back from storage, so they're plain slotted
+# dataclasses. Untrusted input is validated by the API's request types instead.
 @dataclass(frozen=True)
 class Engine:
+    __slots__ = ("family", "variant", "version", "image", "_id")
     family: str
     variant: str
     version: str
     image: str
 
+    def __post_init__(self):
+        # The ID is used as a dict key throughout, so build it once.
+        object.__setattr__(self, "_id", f"{self.family}#{self.variant}#{self.version}")
+
+    def __hash__(self):
+        return hash(self._id)
+
     def id(self):
-        return f"{self.family}#{self.variant}#{self.version}"
+        return self._id
 
     def __str__(self):
         return self.id()
@@ -23,12 +32,14 @@ class Engine:
 
 @dataclass(frozen=True)
 class Move:
+    __slots__ = ("uci", "timestamp")
     uci: str
     timestamp: int # ms since epoch
 
 
 @dataclass(frozen=True)
 class Game:
+    __slots__ = ("game_id", "timestamp", "white", "black", "outcome")
     game_id: str
     timestamp: int  # ms since epoch
     white: str  # Engine UUID
@@ -36,6 +47,15 @@ class Game:
     outcome: Optional[str]
 
 
+def new_id() -> str:
+    # A UUIDv7: the leading bits are the time in ms, so new rows land at the end
+    # of the primary key index rather than on a random page.
+    ms = time.time_ns() // 1_000_000
+    rand = int.from_bytes(os.urandom(10), "big")
+    value = (ms << 80) | (0x7 << 76) | (((rand >> 62) & 0xfff) << 64) | (0b10 << 62) | (rand & ((1 << 62) - 1))
+    return str(uuid.UUID(int=value))
+
+
 class Storage(ABC):
     @abstractmethod
     async def list_engines(self) -> List[Engine]:
@@ -49,6 +69,10 @@ class Storage(ABC):
     async def get_engine(self, engine_id: str) -> Engine:
         raise NotImplementedError()
 
+    @abstractmethod
+    async def get_engines(self, engine_ids: List[str]) -> Dict[str, Engine]:
+        raise NotImplementedError()
+
     @abstractmethod
     async def delete_engine(self, engine_id: str):
         raise NotImplementedError()
@@ -57,6 +81,10 @@ class Storage(ABC):
     async def list_games(self) -> List[Game]:
         raise NotImplementedError()
 
+    @abstractmethod
+    def iter_games(self) -> AsyncIterator[List[Game]]:
+        raise NotImplementedError()
+
     @abstractmethod
     async def store_game(self, game: Game):
         raise NotImplementedError()
@@ -66,7 +94,7 @@ class Storage(ABC):
         raise NotImplementedError()
 
     @abstractmethod
-    async def get_game(self, game_id: str) -> Game:
+    async def get_game(self, game_id: str) -> Optional[Game]:
         raise NotImplementedError()
 
     @abstractmethod
@@ -77,7 +105,14 @@ class Storage(ABC):
     async def store_move(self, game_id: str, move: Move, fen_before: str, engine_id: str):
         raise NotImplementedError()
 
+    @abstractmethod
+    async def store_moves(self, game_id: str, moves: List[Tuple[Move, str, str]]):
+        raise NotImplementedError()
+
     @abstractmethod
     async def moves_in_game(self, game_id: str) -> List[Move]:
         raise NotImplementedError()
 
+    @abstractmethod
+    def iter_moves_in_game(self, game_id: str) -> AsyncIterator[List[Move]]:
+        raise NotImplementedError()
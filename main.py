@@ -1,39 +1,61 @@
+import argparse
 import asyncio
 import logging
 import random
 import sys
 
-import chess.engine
+from sqlalchemy.ext.asyncio import create_async_engine
 
-from chessnet.fargate import FargateEngineManager, FargateRunner
+from chessnet.events import Broker
 from chessnet.game import play_game
-from chessnet.storage import Engine
-from chessnet.sql import SqlStorage
+from chessnet.runner import set_event_loop_policy
+from chessnet.sql import SqlStorage, configure_sqlite
+from chessnet.storage import new_id
 
 log = logging.getLogger(__name__)
 
 
-async def main():
-    engine = create_async_engine("sqlite+aiosqlite:///:memory:", echo=False, future=True)
-    storage = SqlStorage(engine)
+def create_runners(backend, white, black):
+    # Backends are imported on demand, so a local docker game never loads boto3.
+    if backend == "fargate":
+        from chessnet.fargate import FargateEngineManager, FargateRunner
+        manager = FargateEngineManager("chess-net")
+        return FargateRunner(manager, white), FargateRunner(manager, black)
+
+    from chessnet.runner import DockerEngineManager, DockerFileRunner, get_docker_client
+    local = DockerEngineManager(get_docker_client())
+    return DockerFileRunner(local, white), DockerFileRunner(local, black)
 
-    # storage.store_engine(Engine("a", "stockfish", "master", "11", None, "andrijdavid/stockfish:11"))
-    # storage.store_engine(Engine("b", "stockfish", "master", "12", "a", "andrijdavid/stockfish:12"))
-    white = random.choice(storage.list_engines())
-    black = random.choice(storage.list_engines())
 
-    log.info("Connecting to docker daemon...")
-    manager = FargateEngineManager("chess-net")
+async def main(args):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{args.db}", echo=False, future=True)
+    configure_sqlite(engine)
+    storage = SqlStorage(engine)
+    broker = Broker()
 
-    white_runner = FargateRunner(manager, white)
-    black_runner = FargateRunner(manager, black)
+    try:
+        await storage.initialize()
+        engines = await storage.list_engines()
+        white = random.choice(engines)
+        black = random.choice(engines)
 
+        white_runner, black_runner = create_runners(args.backend, white, black)
 
-    log.info(f"Playing {white} against {black}")
-    await play_game(white_runner, black_runner)
+        log.info("Playing %s against %s", white, black)
+        outcome = await play_game(broker, new_id(), white_runner, black_runner)
+        if outcome is not None:
+            log.info("Result: %s", outcome.result())
+    finally:
+        await broker.close()
+        await storage.close()
+        await engine.dispose()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play one game between two random engines.")
+    parser.add_argument("--backend", choices=["fargate", "docker"], default="fargate")
+    parser.add_argument("--db", default="data.sqlite")
+
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
-    asyncio.set_event_loop_policy(chess.engine.EventLoopPolicy())
-    asyncio.run(main())
+    set_event_loop_policy()
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+
+from chessnet.events import Broker, Events, EventType
+from chessnet.storage import Game, Move
+
+game_1 = Game("1", 100, "stockfish#main#11", "alphazero#main#1.0.0", None)
+move_1 = Move("e2e4", 101)
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+
+    async def __call__(self, event):
+        self.events.append(event)
+
+
+async def settle():
+    # Let any dispatched callbacks run to completion.
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+async def broker():
+    broker = Broker()
+    yield broker
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_publish_filters_by_channel_and_type(broker):
+    starts = Recorder()
+    moves = Recorder()
+    broker.subscribe("1", [EventType.START_GAME], starts)
+    broker.subscribe("1", [EventType.MAKE_MOVE], moves)
+
+    start = Events.start_game(game_1)
+    move = Events.make_move("1", move_1, "<fen>", "stockfish#main#11")
+    broker.publish("1", start)
+    broker.publish("1", move)
+    broker.publish("2", Events.start_game(game_1))
+    await settle()
+
+    assert starts.events == [start]
+    assert moves.events == [move]
+
+
+@pytest.mark.asyncio
+async def test_wildcard_subscription(broker):
+    channel = Recorder()
+    wildcard = Recorder()
+    broker.subscribe("1", [EventType.END_GAME], channel)
+    broker.subscribe("*", [EventType.END_GAME], wildcard)
+
+    end_1 = Events.end_game("1", "1-0")
+    end_2 = Events.end_game("2", "0-1")
+    broker.publish("1", end_1)
+    broker.publish("2", end_2)
+    await settle()
+
+    assert channel.events == [end_1]
+    assert wildcard.events == [end_1, end_2]
+
+
+@pytest.mark.asyncio
+async def test_unsubscribe(broker):
+    recorder = Recorder()
+    handle = broker.subscribe("1", [EventType.START_GAME, EventType.END_GAME], recorder)
+
+    broker.unsubscribe(handle)
+    broker.publish("1", Events.start_game(game_1))
+    broker.publish("1", Events.end_game("1", "1-0"))
+    await settle()
+
+    assert recorder.events == []
+    assert broker._index == {}
+
+    # Unknown handles are ignored.
+    broker.unsubscribe(handle)
+
+
+@pytest.mark.asyncio
+async def test_unsubscribe_leaves_other_subscribers(broker):
+    kept = Recorder()
+    removed = Recorder()
+    broker.subscribe("1", [EventType.END_GAME], kept)
+    handle = broker.subscribe("1", [EventType.END_GAME], removed)
+    for game_id in range(2, 100):
+        broker.subscribe(str(game_id), [EventType.END_GAME], removed)
+
+    broker.unsubscribe(handle)
+    end = Events.end_game("1", "1-0")
+    broker.publish("1", end)
+    await settle()
+
+    assert kept.events == [end]
+    assert removed.events == []
+
+
+@pytest.mark.asyncio
+async def test_close_delivers_published_events():
+    broker = Broker()
+    recorder = Recorder()
+    broker.subscribe("1", [EventType.END_GAME], recorder)
+
+    end = Events.end_game("1", "1-0")
+    broker.publish("1", end)
+    await broker.close()
+
+    assert recorder.events == [end]
+
+
+@pytest.mark.asyncio
+async def test_channel_events_handled_in_order():
+    broker = Broker()
+    handled = []
+
+    async def slow_start(event):
+        await asyncio.sleep(0.01)
+        handled.append(event.typ)
+
+    async def end(event):
+        handled.append(event.typ)
+
+    broker.subscribe("*", [EventType.START_GAME], slow_start)
+    broker.subscribe("*", [EventType.END_GAME], end)
+
+    # Published together, so they're dispatched in the same batch.
+    broker.publish("1", Events.start_game(game_1))
+    broker.publish("1", Events.end_game("1", "1-0"))
+    await broker.close()
+
+    assert handled == [EventType.START_GAME, EventType.END_GAME]
@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import pytest
+
+from chessnet.fargate import FargateEngineManager, RunningEngine
+from chessnet.storage import Engine
+
+stockfish = Engine("stockfish", "main", "11", "andrijdavid/stockfish:11")
+
+
+def running_task(task_arn, eni_id):
+    return {
+        "taskArn": task_arn,
+        "lastStatus": "RUNNING",
+        "attachments": [{
+            "status": "ATTACHED",
+            "details": [{"name": "networkInterfaceId", "value": eni_id}],
+        }],
+    }
+
+
+class FakeEcs:
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    def describe_tasks(self, cluster, tasks):
+        return {"tasks": [t for t in self.tasks if t["taskArn"] in tasks]}
+
+
+class FakeEc2:
+    def __init__(self, interfaces):
+        self.interfaces = interfaces
+
+    def describe_network_interfaces(self, NetworkInterfaceIds):
+        return {"NetworkInterfaces": [i for i in self.interfaces if i["NetworkInterfaceId"] in NetworkInterfaceIds]}
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    manager = FargateEngineManager("test")
+    yield manager
+    manager.executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_poll_tasks_resolves_each_task_independently(manager):
+    manager.client = FakeEcs([
+        running_task("a", "eni-a"),
+        running_task("b", "eni-b"),
+        {"taskArn": "c", "lastStatus": "STOPPED"},
+    ])
+    manager.ec2_client = FakeEc2([
+        # No public IP yet, so "a" stays pending.
+        {"NetworkInterfaceId": "eni-a"},
+        {"NetworkInterfaceId": "eni-b", "Association": {"PublicIp": "10.0.0.2"}},
+    ])
+
+    loop = asyncio.get_running_loop()
+    manager.pending_tasks = {arn: loop.create_future() for arn in ["a", "b", "c"]}
+    await manager._poll_tasks(["a", "b", "c"])
+
+    assert not manager.pending_tasks["a"].done()
+    assert manager.pending_tasks["b"].result() == RunningEngine(task_arn="b", ip_addr="10.0.0.2", port=3333)
+    with pytest.raises(Exception, match="unknown reason"):
+        manager.pending_tasks["c"].result()
+
+
+class CountingEcs:
+    def __init__(self):
+        self.described = 0
+        self.registered = 0
+
+    def describe_task_definition(self, taskDefinition, include):
+        self.described += 1
+        time.sleep(0.05)
+        return {"tags": [], "taskDefinition": {"family": taskDefinition}}
+
+    def register_task_definition(self, family, **kwargs):
+        self.registered += 1
+        return {"taskDefinition": {"family": family}}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_task_definition_lookups_are_shared(manager):
+    manager.client = CountingEcs()
+
+    families = await asyncio.gather(*(manager._get_or_create_task_definition(stockfish) for _ in range(5)))
+
+    assert families == ["stockfish_main_11"] * 5
+    assert manager.client.described == 1
+    assert manager.client.registered == 1
+    assert manager.task_definition_lookups == {}
+
+    await manager._get_or_create_task_definition(stockfish)
+    assert manager.client.described == 1
@@ -0,0 +1,94 @@
+import asyncio
+import random
+
+import chess
+import chess.engine
+import pytest
+
+from chessnet.events import Broker, EventType
+from chessnet.game import game_outcome, play_game
+from chessnet.runner import EngineRunner
+from chessnet.storage import Engine
+
+white_engine = Engine("stockfish", "main", "11", "andrijdavid/stockfish:11")
+black_engine = Engine("alphazero", "main", "1.0.0", "deepmind/alphazero:latest")
+
+# Fool's mate.
+white_moves = ["f2f3", "g2g4"]
+black_moves = ["e7e5", "d8h4"]
+
+
+class ScriptedRunner(EngineRunner):
+    def __init__(self, engine, moves):
+        self._engine = engine
+        self.moves = list(moves)
+        self.shutdown_reason = None
+        self.reusable = None
+
+    async def run(self):
+        pass
+
+    async def play(self, board, limit):
+        return chess.engine.PlayResult(chess.Move.from_uci(self.moves.pop(0)), None)
+
+    async def shutdown(self, reason, reusable=False):
+        self.shutdown_reason = reason
+        self.reusable = reusable
+
+    def engine(self):
+        return self._engine
+
+
+@pytest.fixture
+async def broker():
+    broker = Broker()
+    yield broker
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_play_game(broker):
+    events = []
+
+    async def record(event):
+        events.append(event)
+
+    broker.subscribe("1", [EventType.MAKE_MOVE], record)
+
+    white = ScriptedRunner(white_engine, white_moves)
+    black = ScriptedRunner(black_engine, black_moves)
+    outcome = await play_game(broker, "1", white, black)
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+    assert outcome.result() == "0-1"
+    assert white.shutdown_reason == "Game finished successfully"
+    assert black.shutdown_reason == "Game finished successfully"
+    assert white.reusable and black.reusable
+
+    assert [e.move.uci for e in events] == ["f2f3", "e7e5", "g2g4", "d8h4"]
+    assert [e.engine_id for e in events] == [white_engine.id(), black_engine.id()] * 2
+    assert events[0].fen_before == chess.STARTING_FEN
+
+
+@pytest.mark.asyncio
+async def test_aborted_game_engines_not_reusable(broker):
+    # Black runs out of moves, which aborts the game.
+    white = ScriptedRunner(white_engine, white_moves)
+    black = ScriptedRunner(black_engine, black_moves[:1])
+    await play_game(broker, "1", white, black)
+
+    assert black.shutdown_reason.startswith("Game aborted due to error")
+    assert not white.reusable and not black.reusable
+
+
+def test_game_outcome_matches_board_outcome():
+    rng = random.Random(0)
+    for _ in range(20):
+        board = chess.Board()
+        while True:
+            outcome = game_outcome(board)
+            assert outcome == board.outcome()
+            if outcome is not None:
+                break
+            board.push(rng.choice(list(board.legal_moves)))
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from chessnet.pool import WarmPool
+from chessnet.storage import Engine
+
+stockfish = Engine("stockfish", "main", "11", "andrijdavid/stockfish:11")
+alphazero = Engine("alphazero", "main", "1.0.0", "deepmind/alphazero:latest")
+
+
+class FakeManager:
+    def __init__(self):
+        self.started = 0
+        self.stopped = []
+
+    async def run_engine(self, engine):
+        self.started += 1
+        return (engine.id(), self.started)
+
+    async def stop_engine(self, running_engine, reason):
+        self.stopped.append(running_engine)
+
+
+@pytest.fixture
+def manager():
+    return FakeManager()
+
+
+@pytest.mark.asyncio
+async def test_release_and_acquire(manager):
+    pool = WarmPool(manager, max_idle=1, idle_timeout=60)
+    assert pool.acquire(stockfish) is None
+
+    first = await manager.run_engine(stockfish)
+    second = await manager.run_engine(stockfish)
+    pool.release(stockfish, first)
+    # Over max_idle, so this one is stopped.
+    pool.release(stockfish, second)
+    await asyncio.sleep(0)
+
+    assert manager.stopped == [second]
+    assert pool.acquire(alphazero) is None
+    assert pool.acquire(stockfish) == first
+    assert pool.acquire(stockfish) is None
+
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_idle_engines_are_reaped(manager):
+    pool = WarmPool(manager, max_idle=2, idle_timeout=0.01)
+    await pool.prewarm(stockfish, 2)
+
+    await asyncio.sleep(0.05)
+
+    assert len(manager.stopped) == 2
+    assert pool.acquire(stockfish) is None
+
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_close_stops_idle_engines(manager):
+    pool = WarmPool(manager)
+    await pool.prewarm(stockfish, 1)
+    await pool.prewarm(alphazero, 1)
+
+    await pool.close()
+
+    assert sorted(manager.stopped) == sorted([(stockfish.id(), 1), (alphazero.id(), 2)])
+
+
+@pytest.mark.asyncio
+async def test_prewarm_keeps_started_engines(manager):
+    run_engine = manager.run_engine
+
+    async def flaky_run_engine(engine):
+        running_engine = await run_engine(engine)
+        if running_engine[1] == 2:
+            raise Exception("Failed to start")
+        return running_engine
+
+    manager.run_engine = flaky_run_engine
+    pool = WarmPool(manager, max_idle=3)
+    await pool.prewarm(stockfish, 3)
+
+    assert sorted([pool.acquire(stockfish), pool.acquire(stockfish)]) == [(stockfish.id(), 1), (stockfish.id(), 3)]
+    assert pool.acquire(stockfish) is None
+
+    await pool.close()
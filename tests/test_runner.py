@@ -0,0 +1,95 @@
+import asyncio
+import socket
+
+import pytest
+
+from chessnet import runner
+from chessnet.pool import WarmPool
+from chessnet.runner import connect_engine
+from chessnet.storage import Engine
+
+stockfish = Engine("stockfish", "main", "11", "andrijdavid/stockfish:11")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.asyncio
+async def test_connect_engine_retries_until_listening():
+    port = free_port()
+
+    async def listen_later():
+        await asyncio.sleep(0.1)
+        return await asyncio.start_server(lambda r, w: None, host="localhost", port=port)
+
+    server_task = asyncio.ensure_future(listen_later())
+    adapter = await connect_engine("localhost", port)
+    server = await server_task
+
+    assert adapter.alive
+    adapter.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_connect_engine_gives_up(monkeypatch):
+    monkeypatch.setattr(runner, "CONNECT_TIMEOUT", 0.05)
+
+    with pytest.raises(OSError):
+        await connect_engine("localhost", free_port())
+
+
+@pytest.mark.asyncio
+async def test_connect_engine_times_out_hanging_connect(monkeypatch):
+    monkeypatch.setattr(runner, "CONNECT_TIMEOUT", 0.05)
+
+    async def hang(*args, **kwargs):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(asyncio.get_running_loop(), "create_connection", hang)
+    with pytest.raises(asyncio.TimeoutError):
+        await connect_engine("localhost", free_port())
+
+
+class FakeAdapter:
+    alive = True
+
+    def close(self):
+        pass
+
+
+class FakeManager:
+    def __init__(self):
+        self.stopped = []
+
+    async def stop_engine(self, running_engine, reason):
+        self.stopped.append(running_engine)
+
+
+class FakeRunner(runner.ManagedEngineRunner):
+    def address(self, running_engine):
+        return "localhost", 3333
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("reusable", [True, False])
+async def test_managed_runner_only_pools_reusable_engines(reusable):
+    manager = FakeManager()
+    pool = WarmPool(manager)
+    engine_runner = FakeRunner(manager, stockfish, pool)
+    engine_runner.adapter = FakeAdapter()
+    engine_runner.running_engine = "running"
+
+    await engine_runner.shutdown("reason", reusable=reusable)
+
+    if reusable:
+        assert pool.acquire(stockfish) == "running"
+        assert manager.stopped == []
+    else:
+        assert pool.acquire(stockfish) is None
+        assert manager.stopped == ["running"]
+    await pool.close()
@@ -1,8 +1,11 @@
+import asyncio
+
 import pytest
 
 from sqlalchemy.ext.asyncio import create_async_engine
 
 from chessnet.storage import Engine, Game, Move
+from chessnet import sql
 from chessnet.sql import SqlStorage
 
 stockfish = Engine("stockfish", "main", "11", "andrijdavid/stockfish:11")
@@ -17,11 +20,15 @@ move_2 = Move("e7e5", 102)
 
 
 @pytest.fixture
-async def storage():
-    engine = create_async_engine("sqlite+aiosqlite:///:memory:", echo=True, future=True)
+async def storage(tmp_path):
+    # A file rather than :memory:, so that concurrent readers and the move writer
+    # each get their own connection, as they do in the server.
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.sqlite", echo=True, future=True)
     storage = SqlStorage(engine)
     await storage.initialize()
-    return storage
+    yield storage
+    await storage.close()
+    await engine.dispose()
 
 
 @pytest.mark.asyncio
@@ -59,6 +66,8 @@ async def test_games(storage):
     game = await storage.get_game(game_1.game_id)
     assert game == game_1_finished
 
+    assert await storage.get_game("missing") is None
+
 
 @pytest.mark.asyncio
 async def test_moves(storage):
@@ -75,3 +84,260 @@ async def test_moves(storage):
     moves = await storage.moves_in_game(game_1.game_id)
     assert moves == [move_1, move_2]
 
+
+
+@pytest.mark.asyncio
+async def test_engine_cache(storage):
+    await storage.store_engine(stockfish)
+    assert await storage.get_engine(stockfish.id()) == stockfish
+
+    await storage.delete_engine(stockfish.id())
+    with pytest.raises(Exception):
+        await storage.get_engine(stockfish.id())
+
+    await storage.store_engine(alphazero)
+    storage.engine_cache.clear()
+    engines = await asyncio.gather(*(storage.get_engine(alphazero.id()) for _ in range(5)))
+    assert engines == [alphazero] * 5
+    assert storage.engine_fetch_locks == {}
+
+
+@pytest.mark.asyncio
+async def test_get_engines(storage):
+    await storage.store_engine(stockfish)
+    await storage.store_engine(alphazero)
+
+    # Drop the cache so that the engines are fetched from the database.
+    storage.engine_cache.clear()
+    engines = await storage.get_engines([stockfish.id(), alphazero.id()])
+    assert engines == {stockfish.id(): stockfish, alphazero.id(): alphazero}
+
+    engines = await storage.get_engines([stockfish.id(), stockfish.id()])
+    assert engines == {stockfish.id(): stockfish}
+
+    with pytest.raises(Exception):
+        await storage.get_engines([stockfish.id(), "missing"])
+
+
+@pytest.mark.asyncio
+async def test_store_many_moves(storage):
+    await storage.store_engine(stockfish)
+    await storage.store_engine(alphazero)
+    await storage.store_game(game_1)
+
+    moves = [Move("e2e4", ts) for ts in range(300)]
+    for move in moves:
+        await storage.store_move(game_1.game_id, move, "<fen>", stockfish.id())
+
+    assert await storage.moves_in_game(game_1.game_id) == moves
+
+
+@pytest.mark.asyncio
+async def test_iter_games_and_moves(storage):
+    await storage.store_engine(stockfish)
+    await storage.store_engine(alphazero)
+    await storage.store_game(game_1)
+    await storage.store_move(game_1.game_id, move_1, "<fen>", stockfish.id())
+    await storage.store_move(game_1.game_id, move_2, "<fen>", alphazero.id())
+
+    games = [game async for batch in storage.iter_games() for game in batch]
+    assert games == [game_1]
+
+    moves = [move async for batch in storage.iter_moves_in_game(game_1.game_id) for move in batch]
+    assert moves == [move_1, move_2]
+
+
+@pytest.mark.asyncio
+async def test_engines_preloaded(storage):
+    await storage.store_engine(stockfish)
+    await storage.store_engine(alphazero)
+
+    reopened = SqlStorage(storage.db)
+    await reopened.initialize()
+    try:
+        assert reopened.all_engines_cached
+        assert set(reopened.engine_cache) == {stockfish.id(), alphazero.id()}
+        assert set(await reopened.list_engines()) == {stockfish, alphazero}
+
+        await reopened.delete_engine(stockfish.id())
+        assert await reopened.list_engines() == [alphazero]
+    finally:
+        await reopened.close()
+
+
+@pytest.mark.asyncio
+async def test_store_moves(storage):
+    await storage.store_engine(stockfish)
+    await storage.store_engine(alphazero)
+    await storage.store_game(game_1)
+
+    await storage.store_moves(game_1.game_id, [
+        (move_1, "<fen>", stockfish.id()),
+        (move_2, "<fen>", alphazero.id()),
+    ])
+
+    assert await storage.moves_in_game(game_1.game_id) == [move_1, move_2]
+
+
+@pytest.mark.asyncio
+async def test_games_for_engine(storage):
+    await storage.store_engine(stockfish)
+    await storage.store_engine(alphazero)
+    game_2 = Game("2", 200, alphazero.id(), stockfish.id(), None)
+    game_3 = Game("3", 300, alphazero.id(), alphazero.id(), None)
+    await storage.store_game(game_1)
+    await storage.store_game(game_2)
+    await storage.store_game(game_3)
+
+    assert await storage.games_for_engine(stockfish.id()) == [game_2, game_1]
+    assert await storage.games_for_engine(alphazero.id()) == [game_3, game_2, game_1]
+
+
+@pytest.mark.asyncio
+async def test_positions_stored_once(storage):
+    await storage.store_engine(stockfish)
+    await storage.store_engine(alphazero)
+    await storage.store_game(game_1)
+
+    await storage.store_move(game_1.game_id, move_1, "<fen 1>", stockfish.id())
+    await storage.store_move(game_1.game_id, move_2, "<fen 2>", alphazero.id())
+    await storage.flush()
+    # Drop the cache so that existing positions are looked up in the database.
+    storage.position_cache.clear()
+    await storage.store_move(game_1.game_id, Move("g1f3", 103), "<fen 1>", stockfish.id())
+    await storage.flush()
+
+    async with storage.db.connect() as conn:
+        positions = (await conn.execute(storage.positions_table.select())).all()
+        moves = (await conn.execute(storage.moves_table.select())).all()
+    assert sorted(fen for _, fen in positions) == ["<fen 1>", "<fen 2>"]
+    assert moves[0].position_id == moves[2].position_id
+    assert await storage.moves_in_game(game_1.game_id) == [move_1, move_2, Move("g1f3", 103)]
+
+
+@pytest.mark.asyncio
+async def test_store_moves_waits_for_space(tmp_path, monkeypatch):
+    monkeypatch.setattr(sql, "MOVE_QUEUE_SIZE", 2)
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.sqlite", future=True)
+    storage = SqlStorage(engine)
+    await storage.initialize()
+
+    await storage.store_engine(stockfish)
+    await storage.store_game(game_1)
+    moves = [Move("e2e4", ts) for ts in range(10)]
+    await storage.store_moves(game_1.game_id, [(move, "<fen>", stockfish.id()) for move in moves])
+
+    assert await storage.moves_in_game(game_1.game_id) == moves
+    await storage.close()
+    await engine.dispose()
+
+
+# Schema written by versions before the positions table.
+fen_before_schema = [
+    "CREATE TABLE engines (engine_id VARCHAR NOT NULL, family VARCHAR NOT NULL, variant VARCHAR NOT NULL, "
+    "version VARCHAR NOT NULL, image VARCHAR NOT NULL, PRIMARY KEY (engine_id))",
+    "CREATE TABLE games (game_id VARCHAR NOT NULL, timestamp INTEGER NOT NULL, white VARCHAR NOT NULL, "
+    "black VARCHAR NOT NULL, outcome VARCHAR, PRIMARY KEY (game_id))",
+    "CREATE INDEX ix_games_white ON games (white)",
+    "CREATE INDEX ix_games_black ON games (black)",
+    "CREATE TABLE moves (game_id VARCHAR NOT NULL, engine_id VARCHAR NOT NULL, fen_before VARCHAR NOT NULL, "
+    "uci VARCHAR NOT NULL, timestamp INTEGER NOT NULL)",
+    "CREATE INDEX idx_engine_positions ON moves (engine_id, fen_before)",
+    "CREATE INDEX ix_moves_game_id ON moves (game_id)",
+    "CREATE INDEX ix_moves_fen_before ON moves (fen_before)",
+]
+
+
+@pytest.mark.asyncio
+async def test_migrate_fen_before(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/test.sqlite", future=True)
+    async with engine.begin() as conn:
+        for statement in fen_before_schema:
+            await conn.exec_driver_sql(statement)
+        await conn.exec_driver_sql("INSERT INTO engines VALUES (?, ?, ?, ?, ?)", (
+            stockfish.id(), stockfish.family, stockfish.variant, stockfish.version, stockfish.image))
+        await conn.exec_driver_sql("INSERT INTO games VALUES (?, ?, ?, ?, ?)", (
+            game_1.game_id, game_1.timestamp, game_1.white, game_1.black, game_1.outcome))
+        await conn.exec_driver_sql("INSERT INTO moves VALUES (?, ?, ?, ?, ?)", [
+            (game_1.game_id, stockfish.id(), "<fen 1>", move_1.uci, move_1.timestamp),
+            (game_1.game_id, stockfish.id(), "<fen 2>", move_2.uci, move_2.timestamp),
+            (game_1.game_id, stockfish.id(), "<fen 1>", "g1f3", 103),
+        ])
+
+    storage = SqlStorage(engine)
+    await storage.initialize()
+    try:
+        assert await storage.list_engines() == [stockfish]
+        assert await storage.list_games() == [game_1]
+        assert await storage.moves_in_game(game_1.game_id) == [move_1, move_2, Move("g1f3", 103)]
+
+        await storage.store_move(game_1.game_id, Move("b8c6", 104), "<fen 3>", stockfish.id())
+        assert (await storage.moves_in_game(game_1.game_id))[-1] == Move("b8c6", 104)
+
+        async with engine.connect() as conn:
+            positions = (await conn.execute(storage.positions_table.select())).all()
+        assert sorted(fen for _, fen in positions) == ["<fen 1>", "<fen 2>", "<fen 3>"]
+    finally:
+        await storage.close()
+
+    # Already migrated, so initializing again leaves it alone.
+    storage = SqlStorage(engine)
+    await storage.initialize()
+    try:
+        assert len(await storage.moves_in_game(game_1.game_id)) == 4
+    finally:
+        await storage.close()
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_failed_move_batches_are_retried(storage, monkeypatch):
+    monkeypatch.setattr(sql, "MOVE_WRITE_RETRY_DELAYS", [0, 0])
+    await storage.store_engine(stockfish)
+    await storage.store_game(game_1)
+
+    insert_moves = storage._insert_moves
+    failures = []
+
+    async def flaky_insert_moves(rows):
+        if len(failures) < 2:
+            failures.append(rows)
+            raise Exception("database is locked")
+        await insert_moves(rows)
+
+    monkeypatch.setattr(storage, "_insert_moves", flaky_insert_moves)
+    await storage.store_move(game_1.game_id, move_1, "<fen>", stockfish.id())
+
+    assert await storage.moves_in_game(game_1.game_id) == [move_1]
+    assert len(failures) == 2
+
+
+@pytest.mark.asyncio
+async def test_moves_in_game_waits_only_for_its_own_game(storage, monkeypatch):
+    await storage.store_engine(stockfish)
+    await storage.store_game(game_1)
+    game_2 = Game("2", 200, stockfish.id(), stockfish.id(), None)
+    await storage.store_game(game_2)
+    await storage.store_move(game_1.game_id, move_1, "<fen>", stockfish.id())
+    assert await storage.moves_in_game(game_1.game_id) == [move_1]
+
+    # Hold up the writer on game 2's moves.
+    insert_moves = storage._insert_moves
+    unblock = asyncio.Event()
+
+    async def blocked_insert_moves(rows):
+        await unblock.wait()
+        await insert_moves(rows)
+
+    monkeypatch.setattr(storage, "_insert_moves", blocked_insert_moves)
+    await storage.store_move(game_2.game_id, move_1, "<fen>", stockfish.id())
+
+    assert await asyncio.wait_for(storage.moves_in_game(game_1.game_id), 1) == [move_1]
+    reading = asyncio.ensure_future(storage.moves_in_game(game_2.game_id))
+    await asyncio.sleep(0.01)
+    assert not reading.done()
+
+    unblock.set()
+    assert await reading == [move_1]
+    assert storage.pending_moves == {}
+    assert storage.moves_written == {}